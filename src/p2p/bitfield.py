@@ -1,25 +1,46 @@
+# offsets (0 = most significant) of the set bits in every possible byte
+_BIT_OFFSETS = tuple(
+    tuple(j for j in range(8) if b & (0x80 >> j)) for b in range(256)
+)
+
+
 class Bitfield:
+    __slots__ = ("num_pieces", "field")
+
     def __init__(self, num_pieces):
         self.num_pieces = num_pieces
         self.field = bytearray((num_pieces + 7) // 8)
 
     def has_piece(self, index):
-        byte_index = index // 8
-        bit_index = index % 8
-        return bool(self.field[byte_index] & (1 << (7 - bit_index)))
+        return bool(self.field[index >> 3] & (0x80 >> (index & 7)))
 
     def set_piece(self, index):
-        byte_index = index // 8
-        bit_index = index % 8
-        self.field[byte_index] |= (1 << (7 - bit_index))
+        self.field[index >> 3] |= 0x80 >> (index & 7)
+
+    def present_pieces(self):
+        """Return indexes of present pieces."""
+        return self._indexes_of(self._as_int())
 
     def missing_pieces(self):
         """Return indexes of missing pieces."""
-        missing = []
-        for i in range(self.num_pieces):
-            if not self.has_piece(i):
-                missing.append(i)
-        return missing
+        return self._indexes_of(~self._as_int() & ((1 << self.num_pieces) - 1))
+
+    def count_set(self):
+        """Return how many pieces are present."""
+        return self._as_int().bit_count()
+
+    def has_all(self):
+        """Return True if every piece is present."""
+        return self._as_int() == (1 << self.num_pieces) - 1
+
+    def missing_against(self, other):
+        """Return indexes of pieces `other` has that we are missing."""
+        return self._indexes_of(other._as_int() & ~self._as_int())
+
+    def union_inplace(self, other):
+        """Mark every piece present in `other` as present here too."""
+        v = int.from_bytes(self.field, "big") | int.from_bytes(other.field, "big")
+        self.field[:] = v.to_bytes(len(self.field), "big")
 
     def to_bytes(self):
         return bytes(self.field)
@@ -27,11 +48,30 @@ class Bitfield:
     @classmethod
     def from_bytes(cls, data, num_pieces):
         bf = cls(num_pieces)
-        bf.field = bytearray(data)
+        # copy straight into the sized field, a short/long buffer is padded/cut
+        chunk = data[:len(bf.field)]
+        bf.field[:len(chunk)] = chunk
         return bf
 
+    # Helpers
+
+    def _as_int(self):
+        # whole field as one int, bit (num_pieces - 1 - i) is piece i
+        return int.from_bytes(self.field, "big") >> (len(self.field) * 8 - self.num_pieces)
+
+    def _indexes_of(self, bits):
+        # back to byte-aligned form, then decode each nonzero byte via table
+        nbytes = len(self.field)
+        raw = (bits << (nbytes * 8 - self.num_pieces)).to_bytes(nbytes, "big")
+        indexes = []
+        for byte_index, b in enumerate(raw):
+            if b:
+                base = byte_index << 3
+                indexes.extend([base + j for j in _BIT_OFFSETS[b]])
+        return indexes
+
     def __repr__(self):
-        bits = "".join(f"{byte:08b}" for byte in self.field)
+        bits = f"{int.from_bytes(self.field, 'big'):0{len(self.field) * 8}b}"
         return f"<Bitfield {bits[:self.num_pieces]}>"
 
 
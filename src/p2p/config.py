@@ -3,7 +3,7 @@ from pathlib import Path
 from typing import Union
 import math
 
-@dataclass
+@dataclass(slots=True)
 class CommonCfg:
     NumberOfPreferredNeighbors: int
     UnchokingInterval: int
@@ -12,7 +12,7 @@ class CommonCfg:
     FileSize: int
     PieceSize: int
 
-@dataclass
+@dataclass(slots=True)
 class PeerInfo:
     peer_id: int
     host: str
@@ -21,8 +21,13 @@ class PeerInfo:
 
 
 def _is_comment_or_blank(line: str) -> bool:
-    s = line.strip()
-    return not s or s.startswith("#")
+    # lstrip returns the same str when there is no indent, so no copy per line;
+    # bare lstrip() so \f, \v and other whitespace-only lines count as blank
+    return line.lstrip()[:1] in ("", "#")
+
+def _read_lines(path: str | Path) -> list[str]:
+    # config files are small, one read + split beats per-line iteration
+    return Path(path).read_text(encoding="utf-8").splitlines()
 
 def _kv(line: str):
     k, v = line.strip().split(maxsplit=1)
@@ -30,15 +35,14 @@ def _kv(line: str):
 
 def load_common(path: str | Path) -> CommonCfg:
     d ={}
-    with open(path, "r", encoding = "utf-8") as f:
-        for i, line in enumerate(f, 1):
-            if _is_comment_or_blank(line): 
-                continue   
-            try:
-                k, v = _kv(line)
-            except ValueError:
-                raise ValueError(f"{path}:{i}: expected 'Key Value', got {line!r}")
-            d[k] = v
+    for i, line in enumerate(_read_lines(path), 1):
+        if _is_comment_or_blank(line):
+            continue
+        try:
+            k, v = _kv(line)
+        except ValueError:
+            raise ValueError(f"{path}:{i}: expected 'Key Value', got {line!r}")
+        d[k] = v
     try:
         cfg = CommonCfg(
             NumberOfPreferredNeighbors=int(d["NumberOfPreferredNeighbors"]),
@@ -63,23 +67,22 @@ def _validate_common(c: CommonCfg, path: Union[str, Path]) -> None:
     
 def load_peers(path: str | Path) -> list[PeerInfo]:
     peers: list[PeerInfo] = []
-    with open(path, "r", encoding="utf-8") as f:
-        for i, line in enumerate(f, 1):
-            if _is_comment_or_blank(line):
-                continue
-            parts = line.split()
-            if len(parts) != 4:
-                raise ValueError(f"{path}:{i}: expected 'peerID host port hasFile'")
-            pid_s, host, port_s, has_s = parts
-            try:
-                pid  = int(pid_s)
-                port = int(port_s)
-                has  = (int(has_s) == 1)
-            except ValueError:
-                raise ValueError(f"{path}:{i}: peerID/port/hasFile must be integers")
-            if not (1 <= port <= 65535):
-                raise ValueError(f"{path}:{i}: port {port} out of range")
-            peers.append(PeerInfo(pid, host, port, has))
+    for i, line in enumerate(_read_lines(path), 1):
+        if _is_comment_or_blank(line):
+            continue
+        parts = line.split()
+        if len(parts) != 4:
+            raise ValueError(f"{path}:{i}: expected 'peerID host port hasFile'")
+        pid_s, host, port_s, has_s = parts
+        try:
+            pid  = int(pid_s)
+            port = int(port_s)
+            has  = (int(has_s) == 1)
+        except ValueError:
+            raise ValueError(f"{path}:{i}: peerID/port/hasFile must be integers")
+        if not (1 <= port <= 65535):
+            raise ValueError(f"{path}:{i}: port {port} out of range")
+        peers.append(PeerInfo(pid, host, port, has))
     _validate_peers(peers, path)
     return peers
 
@@ -1,38 +1,222 @@
+import os
+import queue
 import socket
-from p2p.messages import Message
+import threading
+from p2p.messages import HEADER_SIZE, Message, parse_header
+
+RECV_BUFFER_SIZE = 64 * 1024
+# the kernel caps this at net.core.rmem_max / wmem_max (see README)
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+_MSG_MORE = getattr(socket, "MSG_MORE", 0)  # Linux only, 0 is a no-op flag
+_TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)  # Linux only
+# a silent peer is probed after 30s idle, every 10s, dropped after 3 misses;
+# unacked data gives up after 60s. Options missing on this platform are skipped
+_KEEPALIVE_OPTS = (
+    ("TCP_KEEPIDLE", 30),
+    ("TCP_KEEPINTVL", 10),
+    ("TCP_KEEPCNT", 3),
+    ("TCP_USER_TIMEOUT", 60_000),  # milliseconds
+)
+# zero-copy file -> socket sends, see Connection.sendfile
+HAS_SENDFILE = hasattr(os, "sendfile")
+
+def configure_socket(sock):
+    # no Nagle delay on small control messages, bigger kernel buffers for pieces
+    # (call before connect() / on the listener so the window scale covers them)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    rearm_quickack(sock)
+    # dead peers surface as a recv error in seconds instead of ~2 hours
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in _KEEPALIVE_OPTS:
+        opt = getattr(socket, name, None)
+        if opt is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, opt, value)
+
+def rearm_quickack(sock):
+    # ACK right away instead of delaying up to ~40 ms; the kernel drops back
+    # to delayed ACKs on its own, so readers re-arm this after each recv
+    if _TCP_QUICKACK is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, _TCP_QUICKACK, 1)
 
 class Connection:
+    __slots__ = (
+        "host", "port", "peer_id", "socket", "_rfile",
+        "_send_lock", "_pending", "_pending_lock", "_inbuf", "_uploads",
+    )
+
     def __init__(self, host, port, peer_id, sock=None):
         self.host = host
         self.port = port
         self.peer_id = peer_id
         self.socket = sock
+        # buffered reader for receive(), made on first use: the reactor reads
+        # through feed() and never needs one
+        self._rfile = None
+        # several threads send on one socket, keep each write whole
+        self._send_lock = threading.Lock()
+        # messages queued by queue(), written out by the next flush/send;
+        # own lock so queueing never waits for a write holding _send_lock
+        self._pending = bytearray()
+        self._pending_lock = threading.Lock()
+        # bytes handed to feed() that don't make a whole message yet
+        self._inbuf = bytearray()
+        # jobs for this connection's upload thread, started by the first submit()
+        self._uploads = None
 
     def connect(self):
         self.socket = socket.create_connection((self.host, self.port))
-        print(f"Connected to peer {self.peer_id} at {self.host}:{self.port}")
+        configure_socket(self.socket)
 
     def send(self, message_bytes):
-        self.socket.sendall(message_bytes)
+        with self._send_lock:
+            # anything queued rides along in the same write
+            self.socket.sendall(self._take_pending() + message_bytes)
+        self._after_write()
+
+    def sendmany(self, *parts):
+        # scatter-gather write, parts go out without being joined first
+        with self._send_lock:
+            pending = self._take_pending()
+            if pending:
+                parts = (pending,) + parts
+            if not hasattr(self.socket, "sendmsg"):
+                self.socket.sendall(b"".join(parts))
+            else:
+                views = [memoryview(p).cast("B") for p in parts]
+                while views:
+                    sent = self.socket.sendmsg(views)
+                    while views and sent >= len(views[0]):
+                        sent -= len(views.pop(0))
+                    if sent:
+                        views[0] = views[0][sent:]
+                del views
+        self._after_write()
+
+    def sendfile(self, header, fd, offset, count):
+        # header from memory, body straight from the page cache to the socket
+        # without passing through Python (callers check HAS_SENDFILE first)
+        with self._send_lock:
+            # MSG_MORE: hold the header back to share a segment with the body
+            self.socket.sendall(self._take_pending() + header, _MSG_MORE)
+            out = self.socket.fileno()
+            while count:
+                sent = os.sendfile(out, fd, offset, count)
+                if not sent:
+                    raise ConnectionError("Connection closed")
+                offset += sent
+                count -= sent
+        self._after_write()
+
+    def submit(self, fn, *args):
+        # run a long blocking write (a whole piece) on this connection's own
+        # upload thread, in submission order, so the caller never waits on a
+        # slow peer; fn handles its own errors
+        if self._uploads is None:
+            self._uploads = queue.SimpleQueue()
+            threading.Thread(target=self._run_uploads, args=(self._uploads,), daemon=True).start()
+        self._uploads.put((fn, args))
+
+    def queue(self, message_bytes):
+        # buffer a message without a syscall, see flush(); only takes the
+        # short pending lock, never waits behind a write in progress
+        with self._pending_lock:
+            self._pending += message_bytes
+
+    def flush(self):
+        with self._send_lock:
+            data = self._take_pending()
+            if data:
+                self.socket.sendall(data)
+
+    def try_flush(self):
+        # best-effort flush that never blocks on a slow peer, whatever the
+        # kernel won't take now stays pending for the next send/flush
+        if not self._send_lock.acquire(blocking=False):
+            return  # a writer holds the socket, it sends pending when done
+        try:
+            data = self._take_pending()
+            if data:
+                sock = self.socket
+                try:
+                    # timeout 0 makes this one send non-blocking on every
+                    # platform (MSG_DONTWAIT doesn't exist on Windows)
+                    timeout = sock.gettimeout()
+                    sock.settimeout(0)
+                    try:
+                        sent = sock.send(data)
+                    finally:
+                        sock.settimeout(timeout)
+                except OSError:
+                    # full buffer, or a dead socket its reader will notice
+                    sent = 0
+                if sent < len(data):
+                    with self._pending_lock:
+                        # ahead of anything queued since, keeps message order
+                        self._pending[0:0] = data[sent:]
+        finally:
+            self._send_lock.release()
+
+    @staticmethod
+    def _run_uploads(jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            fn, args = job
+            fn(*args)
+
+    def _take_pending(self):
+        with self._pending_lock:
+            data = bytes(self._pending)
+            self._pending.clear()
+        return data
+
+    def _after_write(self):
+        # a try_flush that found the socket busy left its bytes to us
+        if self._pending:
+            self.try_flush()
 
     def receive(self):
-        header = self.socket.recv(5)
-        if not header:
+        # blocking read of one message, read(n) loops over recv in C
+        if self._rfile is None:
+            self._rfile = self.socket.makefile("rb", buffering=RECV_BUFFER_SIZE)
+        read = self._rfile.read
+        header = read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
             return None
-        length = int.from_bytes(header[:4], "big")
-        rest = b""
-        while len(rest) < length - 1:
-            part = self.socket.recv(length - 1 - len(rest))
-            if not part:
+        length, msg_type = parse_header(header)
+        return Message(msg_type, read(length - 1))
+
+    def feed(self, data):
+        # for event-driven readers: take whatever recv returned, hand back
+        # every message it completes, keep a partial tail for the next call
+        buf = self._inbuf
+        buf += data
+        messages = []
+        while len(buf) >= HEADER_SIZE:
+            length, msg_type = parse_header(buf)
+            end = 4 + length
+            if len(buf) < end:
                 break
-            rest += part
-        msg_type = header[4]
-        return Message(msg_type, rest)
+            messages.append(Message(msg_type, bytes(memoryview(buf)[HEADER_SIZE:end])))
+            del buf[:end]
+        return messages
 
     def close(self):
+        if self._uploads is not None:
+            self._uploads.put(None)  # upload thread exits after the job in hand
+        if self.socket:
+            # wake a reader blocked in _rfile.read before closing the file
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._rfile:
+            self._rfile.close()
         if self.socket:
             self.socket.close()
-            print(f"Connection closed with peer {self.peer_id}")
 
 
 if __name__ == "__main__":
@@ -45,6 +229,7 @@ if __name__ == "__main__":
         s.bind(("localhost", 5000))
         s.listen()
         conn, addr = s.accept()
+        configure_socket(conn)
         connection = Connection("localhost", peer_id=2, port=5000, sock=conn)
         msg = connection.receive()
         print("Server received:", msg)
@@ -55,6 +240,7 @@ if __name__ == "__main__":
     def client():
         time.sleep(0.5) # wait for server to start
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        configure_socket(s)
         s.connect(("localhost", 5000))
         connection = Connection("localhost", peer_id=1, port=5000, sock=s)
         connection.send(make_have(3))
@@ -5,24 +5,26 @@ import struct
 HANDSHAKE_HEADER = b'P2PFILESHARINGPROJ'
 ZERO_BITS = b'\x00' * 10
 
+# Header + zero bits never change, build them once
+_PREFIX = HANDSHAKE_HEADER + ZERO_BITS
+_PEER_ID = struct.Struct("!I")
+
 # Creates handsake
 def create_handshake(peerID):
-    return HANDSHAKE_HEADER + ZERO_BITS + struct.pack("!I", peerID)
+    return _PREFIX + _PEER_ID.pack(peerID)
 
 # Parses through handskae making sure its valid then returning ID number
 def read_handshake(data):
     if len(data) != 32:
         raise ValueError("Invalid Handshake Length")
 
-    header = data[:18]
-    zeros = data[18:28]
-
-    if header != HANDSHAKE_HEADER:
+    # compare in place instead of slicing out header / zero bits
+    if not data.startswith(HANDSHAKE_HEADER):
         raise ValueError("Invalid handshake header")
-    if zeros != ZERO_BITS:
+    if data.find(ZERO_BITS, 18, 28) != 18:
         raise ValueError("Invalid zero bits section")
 
-    peerID = struct.unpack("!I", data[28:])[0]
+    peerID = _PEER_ID.unpack_from(data, 28)[0]
 
     return peerID
 
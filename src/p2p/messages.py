@@ -1,8 +1,18 @@
 
+import functools
 import struct
 
+# Prebuilt layouts: header (length + type), piece index, piece header
+_HDR = struct.Struct("!IB")
+HEADER_SIZE = _HDR.size
+# (length, message_type) out of the first HEADER_SIZE bytes in one C call
+parse_header = _HDR.unpack_from
+_U32 = struct.Struct("!I")
+_PIECE_HDR = struct.Struct("!IBI")
+
 
 class Message:
+    __slots__ = ("message_type", "payload")
 
     # Constants for message types
     CHOKE = 0
@@ -20,17 +30,16 @@ class Message:
 
     # Encode and decode functions
     def encode(self):
-        length = len(self.payload) + 1
-        return struct.pack("!IB", length, self.message_type) + self.payload
+        return _HDR.pack(len(self.payload) + 1, self.message_type) + self.payload
 
     @staticmethod
     def decode(data):
         if len(data) < 5:
             raise ValueError("Incomplete Message Header")
 
-        length = struct.unpack("!I", data[:4])[0]
-        message_type = struct.unpack("!B", data[4:5])[0]
-        payload = data[5:4+length]
+        length, message_type = _HDR.unpack_from(data)
+        # view into data, the payload is not copied
+        payload = memoryview(data)[5:4+length]
         return Message(message_type, payload)
 
     def __repr__(self):
@@ -49,17 +58,29 @@ def make_interested():
 def make_not_interested():
     return Message(Message.NOT_INTERESTED).encode()
 
+@functools.lru_cache(maxsize=1024)  # bytes are immutable, safe to hand out again
 def make_have(piece_index):
-    payload = struct.pack("!I", piece_index)
+    payload = _U32.pack(piece_index)
     return Message(Message.HAVE, payload).encode()
 
 def make_bitfield(bitfield_bytes):
     return Message(Message.BITFIELD, bitfield_bytes).encode()
 
 def make_request(piece_index):
-    payload = struct.pack("!I", piece_index)
+    payload = _U32.pack(piece_index)
     return Message(Message.REQUEST, payload).encode()
 
 def make_piece(piece_index, data):
-    payload = struct.pack("!I", piece_index) + data
-    return Message(Message.PIECE, payload).encode()
+    # whole header in one pack, so data is copied only once
+    return make_piece_header(piece_index, len(data)) + data
+
+# Just the 9 header bytes of a piece message, lets callers send the data
+# buffer as is (see Connection.sendmany) instead of copying it into a message
+def make_piece_header(piece_index, data_len):
+    return _PIECE_HDR.pack(data_len + 5, Message.PIECE, piece_index)
+
+# Parameter-free messages never change, serialize them once
+CHOKE_BYTES = make_choke()
+UNCHOKE_BYTES = make_unchoke()
+INTERESTED_BYTES = make_interested()
+NOT_INTERESTED_BYTES = make_not_interested()
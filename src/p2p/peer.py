@@ -1,35 +1,47 @@
 from __future__ import annotations
 
+import random
+import struct
+import threading
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
+from p2p.bitfield import Bitfield
 from p2p.config import CommonCfg, PeerInfo, load_common, load_peers
 from p2p.storage import Storage, FileMeta
 from p2p.logger import PeerLogger
 from p2p.messages import (
     Message,
-    make_choke,
-    make_unchoke,
-    make_interested,
-    make_not_interested,
+    CHOKE_BYTES,
+    UNCHOKE_BYTES,
+    INTERESTED_BYTES,
+    NOT_INTERESTED_BYTES,
     make_request,
     make_have,
-    make_piece,
+    make_piece_header,
 )
-from p2p.connection import Connection
+from p2p.connection import HAS_SENDFILE, Connection
+
+# below this many pieces, pick at random to get something to trade quickly
+RANDOM_FIRST_PIECES = 4
+
+# piece index field shared by HAVE / REQUEST / PIECE payloads
+_U32_UNPACK_FROM = struct.Struct("!I").unpack_from
 
 
 @dataclass
 class NeighborState:
     peer_id: int
     connection: Connection
-    bitfield: Optional[bytes] = None  # remote's bitfield
+    bitfield: Optional[bytearray] = None  # remote's bitfield, updated in place
     am_choking: bool = True           # I am choking them
     peer_choking_me: bool = True      # they are choking me
     am_interested: bool = False       # I am interested in them
     peer_interested_me: bool = False  # they are interested in me
     download_bytes_window: int = 0    # bytes downloaded from them in last interval
+    # pieces they have that we don't, kept up to date on BITFIELD / HAVE / PIECE
+    interesting_pieces: Set[int] = field(default_factory=set)
 
 
 class Peer:
@@ -37,14 +49,21 @@ class Peer:
     Core peer logic. All network I/O is done in Connection objects which call:
 
         peer.on_message(connection, message)
+        connection.try_flush()  # once per batch of messages read
+
+    Replies to the sender (INTERESTED, NOT_INTERESTED, REQUEST) are queued on
+    its connection, so a batch of messages is answered with one write.
 
     Scheduler calls:
 
         peer.set_preferred_neighbors([...])
         peer.set_optimistic_unchoke(peer_id)
         stats = peer.get_and_reset_download_stats()
+        peer.flush_pending()
     """
 
+    _HANDLERS: Dict[int, Callable[..., None]] = {}  # filled in after the class body
+
     def __init__(
         self,
         common: CommonCfg,
@@ -52,6 +71,7 @@ class Peer:
         me: PeerInfo,
         storage: Storage,
         logger: Optional[PeerLogger] = None,
+        on_state_change: Optional[Callable[[], None]] = None,
     ) -> None:
         self.common = common
         self.all_peers = all_peers
@@ -64,6 +84,21 @@ class Peer:
 
         # optimistic unchoke tracking
         self.optimistic_unchoke_peer_id: Optional[int] = None
+        # preferred neighbors from the last set_preferred_neighbors call
+        self._preferred_set: Set[int] = set()
+
+        # piece index -> number of neighbors known to have it, for rarest-first
+        self.availability: List[int] = [0] * storage.meta.num_pieces
+        self._availability_lock = threading.Lock()
+
+        # called when we or a neighbor end up with every piece
+        self._on_state_change = on_state_change
+        # what a complete bitfield looks like, spare bits in the last byte clear
+        full = bytearray(b"\xff" * len(storage.bitfield))
+        spare = len(full) * 8 - storage.meta.num_pieces
+        if full and spare:
+            full[-1] = (0xFF << spare) & 0xFF
+        self.full_bitfield = bytes(full)
 
     # Registration / wiring
 
@@ -77,6 +112,14 @@ class Peer:
         )
         self.logger.log(f"TCP connection established with Peer {remote_peer_id}")
 
+    def unregister_connection(self, remote_peer_id: int) -> None:
+        """
+        Called by the networking layer once a connection is gone.
+        """
+        neighbor = self.neighbors.pop(remote_peer_id, None)
+        if neighbor is not None and neighbor.bitfield is not None:
+            self._update_availability(neighbor.bitfield, -1)
+
     # Message entry point (used by Connection.read loop)
 
     def on_message(self, conn: Connection, msg: Message) -> None:
@@ -86,108 +129,144 @@ class Peer:
             # Unknown peer, ignore.
             return
 
-        mtype = msg.message_type
-
-        if mtype == Message.CHOKE:
-            self._handle_choke(neighbor)
-        elif mtype == Message.UNCHOKE:
-            self._handle_unchoke(neighbor)
-        elif mtype == Message.INTERESTED:
-            self._handle_interested(neighbor)
-        elif mtype == Message.NOT_INTERESTED:
-            self._handle_not_interested(neighbor)
-        elif mtype == Message.HAVE:
-            self._handle_have(neighbor, msg)
-        elif mtype == Message.BITFIELD:
-            self._handle_bitfield(neighbor, msg)
-        elif mtype == Message.REQUEST:
-            self._handle_request(neighbor, msg)
-        elif mtype == Message.PIECE:
-            self._handle_piece(neighbor, msg)
+        # one dict lookup instead of an if/elif ladder per message
+        handler = self._HANDLERS.get(msg.message_type)
+        if handler is not None:
+            handler(self, neighbor, msg)
         else:
             # Unknown / unsupported message type
-            self.logger.log(f"Peer {self.me.peer_id}: unknown message type {mtype} from {remote_id}")
+            self.logger.log(
+                f"Peer {self.me.peer_id}: unknown message type {msg.message_type} from {remote_id}"
+            )
 
     # Individual handlers
 
-    def _handle_choke(self, neighbor: NeighborState) -> None:
+    def _handle_choke(self, neighbor: NeighborState, msg: Optional[Message] = None) -> None:
         neighbor.peer_choking_me = True
         self.logger.log(f"Peer {self.me.peer_id} is choked by Peer {neighbor.peer_id}")
 
-    def _handle_unchoke(self, neighbor: NeighborState) -> None:
+    def _handle_unchoke(self, neighbor: NeighborState, msg: Optional[Message] = None) -> None:
         neighbor.peer_choking_me = False
         self.logger.log(f"Peer {self.me.peer_id} is unchoked by Peer {neighbor.peer_id}")
         # Now that we are unchoked, try to request a piece
         self._request_next_piece(neighbor)
 
-    def _handle_interested(self, neighbor: NeighborState) -> None:
+    def _handle_interested(self, neighbor: NeighborState, msg: Optional[Message] = None) -> None:
         neighbor.peer_interested_me = True
         self.logger.log(f"Peer {neighbor.peer_id} is interested in Peer {self.me.peer_id}")
 
-    def _handle_not_interested(self, neighbor: NeighborState) -> None:
+    def _handle_not_interested(self, neighbor: NeighborState, msg: Optional[Message] = None) -> None:
         neighbor.peer_interested_me = False
         self.logger.log(f"Peer {neighbor.peer_id} is not interested in Peer {self.me.peer_id}")
 
     def _handle_have(self, neighbor: NeighborState, msg: Message) -> None:
-        import struct
-
         if len(msg.payload) != 4:
             return
-        (piece_index,) = struct.unpack("!I", msg.payload)
-        self.logger.log(f"Peer {neighbor.peer_id} sent HAVE for piece {piece_index}")
+        piece_index = _U32_UNPACK_FROM(msg.payload)[0]
+        self.logger.log("Peer %d sent HAVE for piece %d", neighbor.peer_id, piece_index)
+        if piece_index >= self.storage.meta.num_pieces:
+            return
 
-        # Update remote bitfield (lazy: we don't decode fully, just track bytes if needed)
-        if neighbor.bitfield is not None:
-            neighbor.bitfield = self._set_bit_in_bytes(neighbor.bitfield, piece_index)
+        # Update remote bitfield in place, starting from empty if they never sent one
+        bits = neighbor.bitfield
+        if bits is None:
+            bits = neighbor.bitfield = bytearray(len(self.storage.bitfield))
+        byte_index = piece_index >> 3
+        mask = 0x80 >> (piece_index & 7)
+        if byte_index < len(bits) and not bits[byte_index] & mask:
+            bits[byte_index] |= mask
+            with self._availability_lock:
+                self.availability[piece_index] += 1
+            if bits == self.full_bitfield:
+                self._notify_state_change()
 
         # Decide if we should be interested
-        if not self.storage.has_piece(piece_index) and not neighbor.am_interested:
+        if self.storage.has_piece(piece_index):
+            return
+        neighbor.interesting_pieces.add(piece_index)
+        if not neighbor.am_interested:
             neighbor.am_interested = True
-            neighbor.connection.send(make_interested())
-            self.logger.log(f"Peer {self.me.peer_id} sent INTERESTED to Peer {neighbor.peer_id}")
+            neighbor.connection.queue(INTERESTED_BYTES)
+            self.logger.debug("Peer %d sent INTERESTED to Peer %d", self.me.peer_id, neighbor.peer_id)
 
     def _handle_bitfield(self, neighbor: NeighborState, msg: Message) -> None:
-        neighbor.bitfield = msg.payload
-        self.logger.log(f"Peer {self.me.peer_id} received BITFIELD from Peer {neighbor.peer_id}")
+        if neighbor.bitfield is not None:
+            self._update_availability(neighbor.bitfield, -1)
+        neighbor.bitfield = bytearray(msg.payload)
+        self._update_availability(neighbor.bitfield, +1)
+        self.logger.debug("Peer %d received BITFIELD from Peer %d", self.me.peer_id, neighbor.peer_id)
+        if neighbor.bitfield == self.full_bitfield:
+            self._notify_state_change()
+
+        # one AND-NOT over the whole field, later HAVE / PIECE keep it current
+        neighbor.interesting_pieces = set(self._interesting_in(msg.payload))
 
         # Determine if we are interested in them
         if self._has_something_we_want(neighbor):
             if not neighbor.am_interested:
                 neighbor.am_interested = True
-                neighbor.connection.send(make_interested())
-                self.logger.log(f"Peer {self.me.peer_id} sent INTERESTED to Peer {neighbor.peer_id}")
+                neighbor.connection.queue(INTERESTED_BYTES)
+                self.logger.debug("Peer %d sent INTERESTED to Peer %d", self.me.peer_id, neighbor.peer_id)
         else:
             if neighbor.am_interested:
                 neighbor.am_interested = False
-                neighbor.connection.send(make_not_interested())
-                self.logger.log(f"Peer {self.me.peer_id} sent NOT_INTERESTED to Peer {neighbor.peer_id}")
+                neighbor.connection.queue(NOT_INTERESTED_BYTES)
+                self.logger.debug(
+                    "Peer %d sent NOT_INTERESTED to Peer %d", self.me.peer_id, neighbor.peer_id
+                )
 
     def _handle_request(self, neighbor: NeighborState, msg: Message) -> None:
-        import struct
-
         if len(msg.payload) != 4:
             return
-        (piece_index,) = struct.unpack("!I", msg.payload)
+        piece_index = _U32_UNPACK_FROM(msg.payload)[0]
 
         # If we are choking them, ignore
         if neighbor.am_choking:
             return
 
-        # If we have that piece, send it
+        # If we have that piece, send it; a whole piece can block on a slow
+        # peer, so it goes out on the connection's upload thread
         if self.storage.has_piece(piece_index):
-            data = self.storage.read_piece(piece_index)
-            neighbor.connection.send(make_piece(piece_index, data))
+            neighbor.connection.submit(self._upload_piece, neighbor, piece_index)
+
+    def _upload_piece(self, neighbor: NeighborState, piece_index: int) -> None:
+        try:
+            if HAS_SENDFILE:
+                fd, offset, length = self.storage.piece_extent(piece_index)
+            else:
+                data = self.storage.read_piece(piece_index)
+        except (OSError, ValueError) as e:
+            # our own file is broken, report it and hang up like a failed reader would;
+            # the reactor sees the closed socket and drops the neighbor
             self.logger.log(
-                f"Peer {self.me.peer_id} uploads piece {piece_index} to Peer {neighbor.peer_id}"
+                "Connection error with peer %d: cannot read piece %d: %s",
+                neighbor.peer_id, piece_index, e,
             )
+            neighbor.connection.close()
+            return
+        try:
+            if HAS_SENDFILE:
+                neighbor.connection.sendfile(
+                    make_piece_header(piece_index, length), fd, offset, length
+                )
+            else:
+                neighbor.connection.sendmany(make_piece_header(piece_index, len(data)), data)
+        except OSError as e:
+            # dead socket, the reader side notices and drops the connection
+            self.logger.debug(
+                "Peer %d failed to upload piece %d to Peer %d: %s",
+                self.me.peer_id, piece_index, neighbor.peer_id, e,
+            )
+            return
+        self.logger.debug(
+            "Peer %d uploads piece %d to Peer %d", self.me.peer_id, piece_index, neighbor.peer_id
+        )
 
     def _handle_piece(self, neighbor: NeighborState, msg: Message) -> None:
-        import struct
-
         if len(msg.payload) < 4:
             return
-        (piece_index,) = struct.unpack("!I", msg.payload[:4])
-        piece_data = msg.payload[4:]
+        piece_index = _U32_UNPACK_FROM(msg.payload)[0]
+        piece_data = memoryview(msg.payload)[4:]  # no copy of the piece bytes
 
         # Write piece to local storage
         self.storage.write_piece(piece_index, piece_data)
@@ -199,24 +278,32 @@ class Peer:
         percent = (have_count / total) * 100.0 if total else 0.0
 
         self.logger.log(
-            f"Peer {self.me.peer_id} has downloaded piece {piece_index} from Peer {neighbor.peer_id}. "
-            f"Now has {have_count}/{total} pieces ({percent:.2f}%)."
+            "Peer %d has downloaded piece %d from Peer %d. Now has %d/%d pieces (%.2f%%).",
+            self.me.peer_id, piece_index, neighbor.peer_id, have_count, total, percent,
         )
 
+        # Nobody is interesting for this piece anymore
+        # snapshot: pool threads may register new connections meanwhile
+        for other in list(self.neighbors.values()):
+            other.interesting_pieces.discard(piece_index)
+
         # Tell everyone we now have this piece
-        self.broadcast_have(piece_index)
+        # (the HAVE to this neighbor stays queued and goes out with our next REQUEST
+        # when the reader flushes this connection)
+        self.broadcast_have(piece_index, skip_flush=neighbor)
 
         # If we are not complete, request another piece from same peer
         if not self.is_complete():
             self._request_next_piece(neighbor)
         else:
             self.logger.log(f"Peer {self.me.peer_id} has downloaded the complete file.")
+            self._notify_state_change()
 
     # Piece selection / requesting
 
     def _request_next_piece(self, neighbor: NeighborState) -> None:
-        # Cannot request if they are choking us or we don't know their bitfield
-        if neighbor.peer_choking_me or neighbor.bitfield is None:
+        # Cannot request if they are choking us
+        if neighbor.peer_choking_me:
             return
 
         piece_index = self._choose_piece_to_request(neighbor)
@@ -224,31 +311,32 @@ class Peer:
             # Nothing to request from this neighbor
             if neighbor.am_interested:
                 neighbor.am_interested = False
-                neighbor.connection.send(make_not_interested())
-                self.logger.log(
-                    f"Peer {self.me.peer_id} sent NOT_INTERESTED to Peer {neighbor.peer_id} (no useful pieces)."
+                neighbor.connection.queue(NOT_INTERESTED_BYTES)
+                self.logger.debug(
+                    "Peer %d sent NOT_INTERESTED to Peer %d (no useful pieces).",
+                    self.me.peer_id, neighbor.peer_id,
                 )
             return
 
-        neighbor.connection.send(make_request(piece_index))
-        self.logger.log(
-            f"Peer {self.me.peer_id} sent REQUEST for piece {piece_index} to Peer {neighbor.peer_id}"
+        neighbor.connection.queue(make_request(piece_index))
+        self.logger.debug(
+            "Peer %d sent REQUEST for piece %d to Peer %d", self.me.peer_id, piece_index, neighbor.peer_id
         )
 
     def _choose_piece_to_request(self, neighbor: NeighborState) -> Optional[int]:
         """
-        Very simple rarest-first-ish: scan all pieces, return first that:
-        - neighbor has
-        - we do not have
+        Rarest-first among the pieces the neighbor has and we do not
+        (random for the first few pieces so we have something to trade).
         """
-        if neighbor.bitfield is None:
+        candidates = neighbor.interesting_pieces
+        if not candidates:
             return None
-
-        num_pieces = self.storage.meta.num_pieces
-        for idx in range(num_pieces):
-            if self._bit_is_set(neighbor.bitfield, idx) and not self.storage.has_piece(idx):
-                return idx
-        return None
+        if self.storage.count_have() < RANDOM_FIRST_PIECES:
+            return random.choice(list(candidates))
+        availability = self.availability
+        rarest = min(availability[i] for i in candidates)
+        # random among the equally rare, or every leecher would chase the lowest index
+        return random.choice([i for i in candidates if availability[i] == rarest])
 
     # Scheduler hooks
 
@@ -259,30 +347,41 @@ class Peer:
         Others should be choked.
         """
         preferred_set = set(preferred_peer_ids)
-        for pid, neighbor in self.neighbors.items():
+        self._preferred_set = preferred_set
+        for pid, neighbor in list(self.neighbors.items()):
             should_unchoke = (pid in preferred_set) or (pid == self.optimistic_unchoke_peer_id)
-            if should_unchoke and neighbor.am_choking:
-                neighbor.am_choking = False
-                neighbor.connection.send(make_unchoke())
-                self.logger.log(
-                    f"Peer {self.me.peer_id} UNCHOKES Peer {pid} (preferred/optimistic)."
-                )
-            elif not should_unchoke and not neighbor.am_choking:
-                neighbor.am_choking = True
-                neighbor.connection.send(make_choke())
-                self.logger.log(
-                    f"Peer {self.me.peer_id} CHOKES Peer {pid} (not preferred)."
-                )
+            self._apply_unchoke_decision(neighbor, should_unchoke)
 
     def set_optimistic_unchoke(self, peer_id: Optional[int]) -> None:
         """
         Called by Scheduler every OptimisticUnchokingInterval.
+        Only the previous and the new optimistic peer can change state.
         """
+        old = self.optimistic_unchoke_peer_id
         self.optimistic_unchoke_peer_id = peer_id
-        # Re-apply choke decisions so this peer gets unchoked if in neighbors
-        self.set_preferred_neighbors(
-            [p for p in self.neighbors if not self.neighbors[p].am_choking]
-        )
+        if old is not None and old != peer_id and old not in self._preferred_set:
+            neighbor = self.neighbors.get(old)
+            if neighbor is not None:
+                self._apply_unchoke_decision(neighbor, False)
+        if peer_id is not None:
+            neighbor = self.neighbors.get(peer_id)
+            if neighbor is not None:
+                self._apply_unchoke_decision(neighbor, True)
+
+    def _apply_unchoke_decision(self, neighbor: NeighborState, should_unchoke: bool) -> None:
+        # sends CHOKE / UNCHOKE only when the state actually changes
+        if should_unchoke and neighbor.am_choking:
+            neighbor.am_choking = False
+            neighbor.connection.send(UNCHOKE_BYTES)
+            self.logger.log(
+                f"Peer {self.me.peer_id} UNCHOKES Peer {neighbor.peer_id} (preferred/optimistic)."
+            )
+        elif not should_unchoke and not neighbor.am_choking:
+            neighbor.am_choking = True
+            neighbor.connection.send(CHOKE_BYTES)
+            self.logger.log(
+                f"Peer {self.me.peer_id} CHOKES Peer {neighbor.peer_id} (not preferred)."
+            )
 
     def get_and_reset_download_stats(self) -> Dict[int, int]:
         """
@@ -295,46 +394,69 @@ class Peer:
             neighbor.download_bytes_window = 0
         return stats
 
+    def flush_pending(self) -> None:
+        """
+        Called by Scheduler every UnchokingInterval, pushes out queued
+        messages a non-blocking flush could not fully send.
+        """
+        for neighbor in list(self.neighbors.values()):
+            neighbor.connection.try_flush()
+
     # Helpers
 
-    def broadcast_have(self, piece_index: int) -> None:
+    def broadcast_have(self, piece_index: int, skip_flush: Optional[NeighborState] = None) -> None:
+        """
+        Queue HAVE on every connection, then flush without blocking on slow
+        peers. The caller can leave one neighbor unflushed so the HAVE shares
+        a write with its next message.
+        """
         payload = make_have(piece_index)
-        for pid, neighbor in self.neighbors.items():
-            neighbor.connection.send(payload)
-        self.logger.log(
-            f"Peer {self.me.peer_id} broadcasted HAVE for piece {piece_index} to all neighbors."
+        neighbors = list(self.neighbors.values())
+        for neighbor in neighbors:
+            neighbor.connection.queue(payload)
+        for neighbor in neighbors:
+            if neighbor is not skip_flush:
+                neighbor.connection.try_flush()
+        self.logger.debug(
+            "Peer %d broadcasted HAVE for piece %d to all neighbors.", self.me.peer_id, piece_index
         )
 
     def is_complete(self) -> bool:
-        return self.storage.count_have() == self.storage.meta.num_pieces
+        return self.storage.is_complete()
+
+    def _notify_state_change(self) -> None:
+        if self._on_state_change is not None:
+            self._on_state_change()
 
     def _has_something_we_want(self, neighbor: NeighborState) -> bool:
-        if neighbor.bitfield is None:
-            return False
-        for idx in range(self.storage.meta.num_pieces):
-            if self._bit_is_set(neighbor.bitfield, idx) and not self.storage.has_piece(idx):
-                return True
-        return False
-
-    @staticmethod
-    def _bit_is_set(bits: bytes, idx: int) -> bool:
-        byte_index, bit_index = divmod(idx, 8)
-        if byte_index >= len(bits):
-            return False
-        mask = 1 << (7 - bit_index)
-        return (bits[byte_index] & mask) != 0
-
-    @staticmethod
-    def _set_bit_in_bytes(bits: bytes, idx: int) -> bytes:
-        b = bytearray(bits)
-        byte_index, bit_index = divmod(idx, 8)
-        if byte_index >= len(b):
-            return bits
-        mask = 1 << (7 - bit_index)
-        b[byte_index] |= mask
-        return bytes(b)
+        return bool(neighbor.interesting_pieces)
 
+    def _update_availability(self, bits: bytes, delta: int) -> None:
+        present = Bitfield.from_bytes(bits, self.storage.meta.num_pieces).present_pieces()
+        with self._availability_lock:
+            availability = self.availability
+            for idx in present:
+                availability[idx] += delta
 
+    def _interesting_in(self, remote_bits: bytes) -> List[int]:
+        # indexes set in remote_bits but not in our local bitfield
+        num_pieces = self.storage.meta.num_pieces
+        theirs = Bitfield.from_bytes(remote_bits, num_pieces)
+        ours = Bitfield.from_bytes(self.storage.bitfield, num_pieces)
+        return ours.missing_against(theirs)
+
+
+# message type -> handler, filled in once the handlers exist
+Peer._HANDLERS = {
+    Message.CHOKE: Peer._handle_choke,
+    Message.UNCHOKE: Peer._handle_unchoke,
+    Message.INTERESTED: Peer._handle_interested,
+    Message.NOT_INTERESTED: Peer._handle_not_interested,
+    Message.HAVE: Peer._handle_have,
+    Message.BITFIELD: Peer._handle_bitfield,
+    Message.REQUEST: Peer._handle_request,
+    Message.PIECE: Peer._handle_piece,
+}
 
 
 def init_runtime(me_id: int, workdir: Optional[Path] = None) -> Tuple[CommonCfg, List[PeerInfo], PeerInfo, Storage]:
@@ -43,6 +43,7 @@ class Scheduler:
 
             with self._lock:
                 self._do_regular_unchoking()
+                self.peer.flush_pending()
 
                 # Optimistic unchoke check
                 now = time.time()
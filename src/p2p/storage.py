@@ -1,6 +1,15 @@
 from __future__ import annotations
 from dataclasses import dataclass
 from pathlib import Path
+import errno
+import mmap
+import os
+import threading
+
+# posix_fallocate errors that mean "not supported here", not "no space"
+_FALLOCATE_UNSUPPORTED = {
+    errno.EOPNOTSUPP, getattr(errno, "ENOTSUP", errno.EOPNOTSUPP), errno.EINVAL, errno.ENOSYS,
+}
 
 
 @dataclass(frozen=True)
@@ -51,39 +60,52 @@ class Storage:
         nbits = meta.num_pieces
         self.bitfield = bytearray((nbits + 7) // 8)
 
+        # pieces present, kept in step with bitfield by _set_bit
+        self._have_count = 0
+        self._bit_lock = threading.Lock()
+        # bumped on every bitfield change, lets callers cache what they derive from it
+        self.bitfield_version = 0
+
+        # file is mapped once on first read/write and kept until close()
+        self._fd: int | None = None
+        self._mm: mmap.mmap | None = None
+        self._map_lock = threading.Lock()
+
         if has_complete_file:
-            # mark all bits 1 (present)
-            for i in range(meta.num_pieces):
-                self._set_bit(i, True)
+            # mark all bits 1 (present), padding bits past the last piece stay 0
+            self.bitfield[:] = b"\xff" * len(self.bitfield)
+            if nbits & 7:
+                self.bitfield[-1] = (0xFF << (8 - (nbits & 7))) & 0xFF
+            self._have_count = nbits
 
         else:
             # empty file if missing
             self._ensure_target_file(meta.file_size)
 
     def has_piece(self, idx: int) -> bool: # return true if we have piece, else false
-        byte, bit = divmod(idx, 8)
-        mask = 1 << (7 - bit)
-        return (self.bitfield[byte] & mask) != 0
+        return (self.bitfield[idx >> 3] & (0x80 >> (idx & 7))) != 0
 
     def mark_have(self, idx: int) -> None: # mark as present in local bitfield
         self._set_bit(idx, True)
 
     def count_have(self) -> int: # count pieces
-        # Count set bits
-        return sum(bin(b).count("1") for b in self.bitfield)
+        return self._have_count
+
+    def is_complete(self) -> bool: # true once every piece is present
+        return self._have_count == self.meta.num_pieces
 
     def raw_bitfield(self) -> bytes: # return bitfield as raw bytes
         return bytes(self.bitfield)
 
     def read_piece(self, idx: int) -> bytes: # read exact bytes
         plen = self.meta.piece_len(idx)
-        with open(self.data_path, "rb") as f:
-            f.seek(idx * self.meta.piece_size)
-            data = f.read(plen)
-            if len(data) != plen:
-                # file might be incomplete/corrupt locally.
-                raise IOError(f"short read for piece {idx}: expected {plen}, got {len(data)}")
-            return data
+        start = idx * self.meta.piece_size
+        # straight out of the page cache, no open/seek/read per piece
+        return self._mapping()[start:start + plen]
+
+    def piece_extent(self, idx: int) -> tuple[int, int, int]: # (fd, offset, length) for os.sendfile
+        self._mapping()  # opens the data file on first use
+        return self._fd, idx * self.meta.piece_size, self.meta.piece_len(idx)
 
     def write_piece(self, idx: int, content: bytes) -> None: # write bytes for piece to disk
         expected = self.meta.piece_len(idx)
@@ -91,38 +113,74 @@ class Storage:
             raise ValueError(
                 f"wrong size for piece {idx}: expected {expected}, got {len(content)}"
             )
-        # ensure container file exists & sized
-        self._ensure_target_file(self.meta.file_size)
-
-        with open(self.data_path, "r+b") as f:
-            f.seek(idx * self.meta.piece_size)
-            f.write(content)
+        # container file was created & sized in __init__
+        start = idx * self.meta.piece_size
+        self._mapping()[start:start + expected] = content
 
         self.mark_have(idx)
 
+    def close(self) -> None: # unmap and release the data file
+        with self._map_lock:
+            if self._mm is not None:
+                self._mm.close()
+                os.close(self._fd)
+                self._mm = None
+                self._fd = None
+
     """
         Helpers 
     """
 
+    def _mapping(self) -> mmap.mmap: # shared read/write map of the whole file
+        mm = self._mm
+        if mm is None:
+            with self._map_lock:
+                if self._mm is None:
+                    fd = os.open(self.data_path, os.O_RDWR)
+                    size = os.fstat(fd).st_size
+                    if size < self.meta.file_size:
+                        # file might be incomplete/corrupt locally.
+                        os.close(fd)
+                        raise IOError(
+                            f"{self.data_path} is {size} bytes, expected {self.meta.file_size}"
+                        )
+                    self._mm = mmap.mmap(fd, self.meta.file_size, access=mmap.ACCESS_WRITE)
+                    self._fd = fd
+                mm = self._mm
+        return mm
+
     def _ensure_target_file(self, target_size: int) -> None: # make sure filename exists and is target size bytes
-        if not self.data_path.exists():
-            # create empty file
-            with open(self.data_path, "wb") as _:
-                pass
-        # grow file if smaller than target
-        current = self.data_path.stat().st_size
-        if current < target_size:
-            # extend by seeking to last byte and writing one zero.
-            with open(self.data_path, "r+b") as f:
-                f.seek(target_size - 1)
-                f.write(b"\x00")
+        fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # grow file if smaller than target
+            if os.fstat(fd).st_size < target_size:
+                try:
+                    # reserve real blocks up front, no ENOSPC / block faults mid-download
+                    os.posix_fallocate(fd, 0, target_size)
+                except AttributeError:
+                    # not on this platform, plain (sparse) resize
+                    os.ftruncate(fd, target_size)
+                except OSError as e:
+                    # only "this filesystem can't" falls back, a full disk must fail now
+                    if e.errno not in _FALLOCATE_UNSUPPORTED:
+                        raise
+                    os.ftruncate(fd, target_size)
+        finally:
+            os.close(fd)
 
     def _set_bit(self, idx: int, val: bool) -> None: # set/ clear bit for piece
         if not (0 <= idx < self.meta.num_pieces):
             raise IndexError(f"piece index out of range: {idx}")
-        byte, bit = divmod(idx, 8)
-        mask = 1 << (7 - bit)
-        if val:
-            self.bitfield[byte] |= mask
-        else:
-            self.bitfield[byte] &= ~mask
\ No newline at end of file
+        byte = idx >> 3
+        mask = 0x80 >> (idx & 7)
+        # pieces can arrive on several connection threads at once
+        with self._bit_lock:
+            was = (self.bitfield[byte] & mask) != 0
+            if val and not was:
+                self.bitfield[byte] |= mask
+                self._have_count += 1
+                self.bitfield_version += 1
+            elif was and not val:
+                self.bitfield[byte] &= ~mask
+                self._have_count -= 1
+                self.bitfield_version += 1
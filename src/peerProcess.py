@@ -1,18 +1,23 @@
+import functools
+import selectors
 import sys
 import socket
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from p2p.config import load_common, load_peers
 from p2p.logger import PeerLogger
 from p2p.handshake import create_handshake, read_handshake
-from p2p.storage import Storage, FileMeta
-from p2p.peer import Peer
-from p2p.connection import Connection
+from p2p.peer import Peer, init_runtime
+from p2p.connection import RECV_BUFFER_SIZE, Connection, configure_socket, rearm_quickack
 from p2p.scheduler import Scheduler
 from p2p.messages import make_bitfield
 
+# an earlier peer may still be binding its listener when we dial it
+CONNECT_ATTEMPTS = 10
+CONNECT_RETRY_MAX_DELAY = 1.0
+
 
 class PeerConnection:
     def __init__(self, peer_id, sock, is_initiator):
@@ -26,23 +31,27 @@ class PeerConnection:
         self.bitfield = None
         self.download_rate = 0
         self.bytes_downloaded = 0
-        self.lock = threading.Lock()
+        self.send_errors = 0
 
     def send_message(self, msg_bytes):
         try:
             self.sock.sendall(msg_bytes)
             return True
-        except Exception as e:
-            print(f"Error sending to peer {self.peer_id}: {e}")
+        except Exception:
+            # counted, not printed: the caller decides what a failed send means
+            self.send_errors += 1
             return False
 
     def recv_exact(self, n):
-        data = b''
-        while len(data) < n:
-            chunk = self.sock.recv(n - len(data))
-            if not chunk:
+        # fill one preallocated buffer in place instead of re-concatenating
+        data = bytearray(n)
+        view = memoryview(data)
+        got = 0
+        while got < n:
+            k = self.sock.recv_into(view[got:], n - got)
+            if not k:
                 raise ConnectionError("Connection closed")
-            data += chunk
+            got += k
         return data
 
 
@@ -51,37 +60,26 @@ class PeerProcess:
         self.my_id = my_id
         self.workdir = workdir or Path(".")
 
-        self.common = load_common(self.workdir / "Common.cfg")
-        self.all_peers = load_peers(self.workdir / "PeerInfo.cfg")
-        self.me = next(p for p in self.all_peers if p.peer_id == my_id)
+        self.common, self.all_peers, self.me, self.storage = init_runtime(my_id, self.workdir)
+        self.meta = self.storage.meta
 
         self.logger = PeerLogger(my_id)
 
-        self.meta = FileMeta(
-            file_name=self.common.FileName,
-            file_size=self.common.FileSize,
-            piece_size=self.common.PieceSize,
-        )
-
-        self.storage = Storage(
-            workdir=self.workdir,
-            peer_id=my_id,
-            meta=self.meta,
-            has_complete_file=self.me.has_file,
-            create_dirs=True,
-        )
-
         if self.me.has_file:
             src = self.workdir / self.common.FileName
             if src.exists() and not self.storage.data_path.exists():
                 self.storage.data_path.write_bytes(src.read_bytes())
 
+        # set by the peer when completion may have changed, wakes start()'s loop
+        self._state_changed = threading.Event()
+
         self.peer = Peer(
             common=self.common,
             all_peers=self.all_peers,
             me=self.me,
             storage=self.storage,
             logger=self.logger,
+            on_state_change=self._state_changed.set,
         )
 
         self.scheduler = Scheduler(
@@ -91,8 +89,31 @@ class PeerProcess:
             num_preferred=self.common.NumberOfPreferredNeighbors,
         )
 
+        # the set of peers we must be connected to never changes
+        self._expected_peer_ids = frozenset(
+            p.peer_id for p in self.all_peers if p.peer_id != self.my_id
+        )
+        self._expected_count = len(self._expected_peer_ids)
+        # peers started before us, we dial these and the rest dial us
+        self._earlier_peers = tuple(p for p in self.all_peers if p.peer_id < self.my_id)
+
+        # our handshake never changes, every connection shares these 32 bytes
+        self._my_handshake = create_handshake(my_id)
+        # (storage.bitfield_version, BITFIELD message) for _opening_bytes
+        self._bitfield_msg_cache = (None, b"")
+
+        # readiness for the listener and all peer sockets, see _run_reactor
+        self._sel = selectors.DefaultSelector()
+        # one receive buffer reused by every recv on the reactor thread
+        self._recv_view = memoryview(bytearray(RECV_BUFFER_SIZE))
+
         self.server_socket = None
         self.running = True
+        # set once the listener is up (or failed to come up) / the reactor has exited
+        self._server_ready = threading.Event()
+        self._reactor_stopped = threading.Event()
+        # why the listener could not be opened, checked by start()
+        self._server_error = None
 
         self.logger.log(
             f"Peer {my_id} initialized: {self.meta.num_pieces} pieces, "
@@ -103,13 +124,20 @@ class PeerProcess:
         server_thread = threading.Thread(target=self.run_server, daemon=True)
         server_thread.start()
 
-        time.sleep(1)
+        self._server_ready.wait()
+        if self._server_error is not None:
+            # no listener means no reactor, so no socket would ever be read
+            message = f"Cannot listen on {self.me.host}:{self.me.port}: {self._server_error}"
+            self.logger.log(message)
+            self.shutdown()
+            raise SystemExit(f"[Peer {self.my_id}] {message}")
 
-        earlier_peers = [p for p in self.all_peers if p.peer_id < self.my_id]
-        for peer_info in earlier_peers:
-            self.connect_to_peer(peer_info)
+        earlier_peers = self._earlier_peers
+        if earlier_peers:
+            # overlap the TCP + protocol handshakes instead of dialing one by one
+            with ThreadPoolExecutor(max_workers=min(16, len(earlier_peers))) as pool:
+                list(pool.map(self.connect_to_peer, earlier_peers))
 
-        time.sleep(2)
         self.scheduler.start()
 
         completion_time = None
@@ -118,7 +146,10 @@ class PeerProcess:
 
         try:
             while self.running:
-                time.sleep(2)
+                # woken as soon as a neighbor or we finish, the timeout keeps
+                # the shutdown delay ticking and notices dropped connections
+                self._state_changed.wait(timeout=1.0)
+                self._state_changed.clear()
 
                 # track if we've ever had at least one neighbor
                 if self.peer.neighbors:
@@ -158,95 +189,111 @@ class PeerProcess:
         if not self.peer.is_complete():
             return False
 
-        for neighbor in self.peer.neighbors.values():
-            if neighbor.bitfield is None:
-                return False
-
-            for i in range(self.meta.num_pieces):
-                if not self.peer._bit_is_set(neighbor.bitfield, i):
-                    return False
-
-        connected_peer_ids = set(self.peer.neighbors.keys())
-        all_peer_ids = {p.peer_id for p in self.all_peers if p.peer_id != self.my_id}
-
-        if connected_peer_ids != all_peer_ids:
+        neighbors = self.peer.neighbors
+        if len(neighbors) != self._expected_count:
             return False
 
-        return True
+        # one bytes compare per neighbor instead of a per-bit loop
+        full = self.peer.full_bitfield
+        for neighbor in neighbors.values():
+            if neighbor.bitfield != full:
+                return False
+
+        # same count, but make sure it is the same peers
+        return self._expected_peer_ids.issuperset(neighbors)
 
     def run_server(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.me.host, self.me.port))
-        self.server_socket.listen(10)
+        try:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # accepted sockets inherit these where the OS supports it, buffer sizes
+            # must be on the listener to count for the window negotiated at SYN time
+            configure_socket(self.server_socket)
+            self.server_socket.bind((self.me.host, self.me.port))
+            self.server_socket.listen(10)
+        except OSError as e:
+            self._server_error = e
+            self._reactor_stopped.set()  # nothing for shutdown() to wait for
+            return
+        finally:
+            # never leave start() waiting, even if bind failed
+            self._server_ready.set()
 
         self.logger.log(f"Listening on {self.me.host}:{self.me.port}")
-        print(f"[Peer {self.my_id}] Listening on {self.me.host}:{self.me.port}")
 
-        while self.running:
-            try:
-                self.server_socket.settimeout(1.0)
-                try:
-                    client_sock, addr = self.server_socket.accept()
-                except socket.timeout:
-                    continue
-
-                thread = threading.Thread(
-                    target=self.handle_incoming_connection,
-                    args=(client_sock,),
-                    daemon=True
-                )
-                thread.start()
+        # one thread serves the listener and every peer socket
+        self.server_socket.setblocking(False)
+        self._sel.register(self.server_socket, selectors.EVENT_READ, self._on_accept)
+        self._run_reactor()
 
-            except Exception as e:
-                if self.running:
-                    self.logger.log(f"Server error: {e}")
+    def _run_reactor(self):
+        try:
+            while self.running:
+                for key, _ in self._sel.select(timeout=1.0):
+                    callback = key.data
+                    try:
+                        callback(key.fileobj)
+                    except Exception as e:
+                        if self.running:
+                            self.logger.log(f"Reactor error: {e}")
+        finally:
+            self._sel.close()
+            self._reactor_stopped.set()
 
-    def handle_incoming_connection(self, client_sock):
+    def _on_accept(self, server_sock):
         try:
-            handshake_data = client_sock.recv(32)
-            if len(handshake_data) != 32:
-                client_sock.close()
+            client_sock, addr = server_sock.accept()
+        except BlockingIOError:
+            return
+        client_sock.setblocking(True)
+        configure_socket(client_sock)
+        # nothing is known about the peer until its 32-byte handshake is in
+        self._sel.register(
+            client_sock,
+            selectors.EVENT_READ,
+            functools.partial(self._on_handshake_readable, bytearray()),
+        )
+
+    def _on_handshake_readable(self, handshake_data, client_sock):
+        try:
+            # never read past the handshake, what follows belongs to the Connection
+            chunk = client_sock.recv(32 - len(handshake_data))
+            if not chunk:
+                raise ConnectionError("closed before handshake")
+            handshake_data += chunk
+            if len(handshake_data) < 32:
                 return
 
-            remote_peer_id = read_handshake(handshake_data)
+            remote_peer_id = read_handshake(bytes(handshake_data))
 
             self.logger.log(f"Peer {self.my_id} is connected from Peer {remote_peer_id}.")
 
-            my_handshake = create_handshake(self.my_id)
-            client_sock.sendall(my_handshake)
-
-            conn = Connection(
-                host=self.me.host,
-                port=self.me.port,
-                peer_id=remote_peer_id,
-                sock=client_sock
-            )
-
-            self.peer.register_connection(remote_peer_id, conn)
-
-            if self.storage.count_have() > 0:
-                bitfield_msg = make_bitfield(self.storage.raw_bitfield())
-                conn.send(bitfield_msg)
-
-            self.handle_peer_messages(conn)
-
+            client_sock.sendall(self._opening_bytes())
         except Exception as e:
             self.logger.log(f"Error handling incoming connection: {e}")
-            try:
-                client_sock.close()
-            except:
-                pass
+            self._sel.unregister(client_sock)
+            client_sock.close()
+            return
+
+        conn = Connection(
+            host=self.me.host,
+            port=self.me.port,
+            peer_id=remote_peer_id,
+            sock=client_sock
+        )
+
+        self.peer.register_connection(remote_peer_id, conn)
+        self._sel.modify(
+            client_sock, selectors.EVENT_READ, functools.partial(self._on_peer_readable, conn)
+        )
 
     def connect_to_peer(self, peer_info):
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((peer_info.host, peer_info.port))
+            sock = self._dial(peer_info)
 
             self.logger.log(f"Peer {self.my_id} makes a connection to Peer {peer_info.peer_id}.")
 
-            my_handshake = create_handshake(self.my_id)
-            sock.sendall(my_handshake)
+            sock.sendall(self._opening_bytes())
 
             handshake_data = sock.recv(32)
             if len(handshake_data) != 32:
@@ -270,40 +317,90 @@ class PeerProcess:
             )
 
             self.peer.register_connection(remote_peer_id, conn)
-
-            if self.storage.count_have() > 0:
-                bitfield_msg = make_bitfield(self.storage.raw_bitfield())
-                conn.send(bitfield_msg)
-
-            thread = threading.Thread(
-                target=self.handle_peer_messages,
-                args=(conn,),
-                daemon=True
+            self._sel.register(
+                sock, selectors.EVENT_READ, functools.partial(self._on_peer_readable, conn)
             )
-            thread.start()
 
         except Exception as e:
             self.logger.log(f"Failed to connect to peer {peer_info.peer_id}: {e}")
 
-    def handle_peer_messages(self, conn: Connection):
+    def _dial(self, peer_info):
+        # short backoff on "refused" rather than a fixed sleep before dialing
+        delay = 0.05
+        for attempt in range(CONNECT_ATTEMPTS):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # before connect() so the larger window is part of the handshake
+            configure_socket(sock)
+            try:
+                sock.connect((peer_info.host, peer_info.port))
+                return sock
+            except ConnectionRefusedError:
+                sock.close()
+                if attempt == CONNECT_ATTEMPTS - 1:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, CONNECT_RETRY_MAX_DELAY)
+
+    def _opening_bytes(self):
+        # handshake and initial bitfield leave in one write / one segment
+        if self.storage.count_have() > 0:
+            return self._my_handshake + self._bitfield_msg()
+        return self._my_handshake
+
+    def _bitfield_msg(self):
+        # rebuilt only after a piece completes, not once per connection
+        version = self.storage.bitfield_version
+        cached = self._bitfield_msg_cache
+        if cached[0] != version:
+            # version read before the bits: a racing update only costs a rebuild
+            cached = (version, make_bitfield(self.storage.raw_bitfield()))
+            self._bitfield_msg_cache = cached
+        return cached[1]
+
+    def _on_peer_readable(self, conn: Connection, sock):
+        # the socket is readable, so this recv returns without blocking
         try:
-            while self.running:
-                msg = conn.receive()
-                if msg is None:
-                    break
+            n = sock.recv_into(self._recv_view)
+        except BlockingIOError:
+            # spurious wakeup while another thread's try_flush had the socket
+            # in non-blocking mode, wait for the next readiness event
+            return
+        except OSError as e:
+            self.logger.log(f"Connection error with peer {conn.peer_id}: {e}")
+            n = 0
+        if not n:
+            self._drop_connection(conn)
+            return
+        rearm_quickack(sock)
 
+        failed = False
+        try:
+            for msg in conn.feed(self._recv_view[:n]):
                 self.peer.on_message(conn, msg)
-
         except Exception as e:
-            self.logger.log(f"Connection error with peer {conn.peer_id}: {e}")
+            # feed() already took the whole batch out of the buffer, the rest of
+            # it is lost, so don't keep talking to this peer half in sync
+            self.logger.log(f"Error handling message from peer {conn.peer_id}: {e}")
+            failed = True
         finally:
-            try:
-                conn.close()
-            except:
-                pass
+            # every reply the batch queued goes out in one write; try_flush never
+            # blocks the reactor on a slow peer, what's left goes with the next write
+            conn.try_flush()
+        if failed:
+            self._drop_connection(conn)
+
+    def _drop_connection(self, conn: Connection):
+        try:
+            self._sel.unregister(conn.socket)
+        except (KeyError, ValueError):
+            pass
+        try:
+            conn.close()
+        except:
+            pass
+        self.logger.debug("Connection closed with peer %d", conn.peer_id)
 
-            if conn.peer_id in self.peer.neighbors:
-                del self.peer.neighbors[conn.peer_id]
+        self.peer.unregister_connection(conn.peer_id)
 
     def shutdown(self):
         self.running = False
@@ -328,7 +425,10 @@ class PeerProcess:
         self.logger.log(f"Peer {self.my_id} shut down gracefully")
         print(f"[Peer {self.my_id}] Shutdown complete")
 
-        time.sleep(0.5)
+        # the reactor sees running == False within one select timeout
+        self._reactor_stopped.wait(timeout=2.0)
+        self.storage.close()
+        self.logger.close()
 
 
 def main():